@@ -3,11 +3,18 @@
 
 import os
 import re
+import math
+import zipfile
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import chain, repeat
 from pathlib import Path
+from typing import Iterable
+from xml.sax.saxutils import escape, quoteattr
 
 import pandas as pd
-import pdfplumber
+import pypdfium2 as pdfium
 
 from lohnjournal_parser import CoordinateLohnjournalParser, LohnjournalDatabase
 
@@ -29,146 +36,266 @@ EXPORT_COLUMNS = [
 
 SUM_COLUMNS = EXPORT_COLUMNS[5:]  # All numeric columns after ki_freibetrag
 
+_MONTH_RE = re.compile(r'(\w+)_(\d{4})')
+_XML_ILLEGAL_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
 
 def extract_month_year(filename: str) -> tuple:
     """Extract month and year from filename like 'Januar_2025.pdf'."""
-    if match := re.search(r'(\w+)_(\d{4})', filename):
+    if match := _MONTH_RE.search(filename):
         month_name, year = match.group(1), int(match.group(2))
         return month_name, year, MONTH_ORDER.get(month_name, 0)
     return None, None, 0
 
 
-def find_password(pdf_path: str, passwords: list) -> str | None:
-    """Find working password for PDF."""
+def open_pdf(pdf_path: str, passwords: list) -> pdfium.PdfDocument | None:
+    """Open PDF with the first working password, return the open handle."""
     for pwd in passwords:
         try:
-            with pdfplumber.open(pdf_path, password=pwd) as pdf:
-                _ = pdf.pages[0].extract_text()
-                return pwd
+            pdf = pdfium.PdfDocument(pdf_path, password=pwd or None)
         except Exception:
             continue
+        try:
+            textpage = pdf[0].get_textpage()
+            _ = textpage.get_text_range(0, textpage.count_chars())
+            return pdf
+        except Exception:
+            pdf.close()
+    return None
+
+
+def find_password(pdf_path: str, passwords: list) -> str | None:
+    """Return the first password that opens the PDF, or None."""
+    for pwd in passwords:
+        pdf = open_pdf(pdf_path, [pwd])
+        if pdf is not None:
+            pdf.close()
+            return pwd
     return None
 
 
-def process_pdfs(pdf_folder: str, passwords: list) -> list:
+def to_df(employees: Iterable) -> pd.DataFrame:
+    """Convert employee records to a DataFrame with the database FIELDS as columns."""
+    df = pd.DataFrame(
+        [tuple(LohnjournalDatabase.field_value(emp, f) for f in LohnjournalDatabase.FIELDS) for emp in employees],
+        columns=LohnjournalDatabase.FIELDS,
+    )
+    # float64, not float32: amounts must keep their exact cents
+    return df.astype({col: 'float64' for col in SUM_COLUMNS})
+
+
+def _parse_one(pf: tuple, passwords: list, collect_raw: bool = False) -> dict | None:
+    """Parse a single PDF file tuple, return its result dict or None on failure."""
+    filename, path, month_name, year, month_num = pf
+    print(f"\nProcessing: {month_name} {year}")
+    
+    pdf = open_pdf(path, passwords)
+    if pdf is None:
+        print(f"  ERROR: Could not open {filename} (wrong password?)")
+        return None
+    
+    try:
+        # The parser takes over the open handle and closes it when done
+        parser = CoordinateLohnjournalParser(path, collect_raw=collect_raw, pdf=pdf)
+        df = to_df(parser.iter_parse())
+        print(f"  Extracted: {len(df)} employees")
+        
+        return {
+            'month_name': month_name,
+            'year': year,
+            'month_num': month_num,
+            'sort_key': year * 100 + month_num,
+            'table_name': f"lohnjournal_{month_name}_{year}",  # sanitized by create_table
+            'df': df,
+            'metadata': parser.metadata
+        }
+    except Exception as e:
+        print(f"  ERROR: {e}")
+        return None
+
+
+def process_pdfs(pdf_folder: str, passwords: list, collect_raw: bool = False) -> list:
     """Process all PDFs in folder, return list of results."""
-    # Find and sort PDF files
-    pdf_files = []
-    for f in os.listdir(pdf_folder):
-        if f.lower().endswith('.pdf'):
-            month_name, year, month_num = extract_month_year(f)
-            if month_name:
-                pdf_files.append({
-                    'filename': f,
-                    'path': os.path.join(pdf_folder, f),
-                    'month_name': month_name,
-                    'year': year,
-                    'month_num': month_num,
-                    'sort_key': year * 100 + month_num
-                })
-    
-    pdf_files.sort(key=lambda x: x['sort_key'])
+    # Find and sort PDF files as (filename, path, month_name, year, month_num)
+    with os.scandir(pdf_folder) as it:
+        pdf_files = [
+            (f.name, f.path, *extract_month_year(f.name))
+            for f in it if f.is_file() and f.name.lower().endswith('.pdf')
+        ]
+    pdf_files = [pf for pf in pdf_files if pf[2]]
+    pdf_files.sort(key=lambda pf: pf[3] * 100 + pf[4])
     print(f"Found {len(pdf_files)} PDF files")
     
-    results = []
-    for pf in pdf_files:
-        print(f"\nProcessing: {pf['month_name']} {pf['year']}")
-        
-        password = find_password(pf['path'], passwords)
-        if not password and passwords[0]:  # Skip password check if no password needed
-            print(f"  ERROR: Could not find password for {pf['filename']}")
-            continue
-        
-        try:
-            parser = CoordinateLohnjournalParser(pf['path'], password=password)
-            employees = parser.parse()
-            print(f"  Extracted: {len(employees)} employees")
-            
-            results.append({
-                'month_name': pf['month_name'],
-                'year': pf['year'],
-                'month_num': pf['month_num'],
-                'sort_key': pf['sort_key'],
-                'table_name': re.sub(r'[^a-zA-Z0-9_]', '_', f"lohnjournal_{pf['month_name']}_{pf['year']}"),
-                'employees': employees,
-                'metadata': parser.metadata
-            })
-        except Exception as e:
-            print(f"  ERROR: {e}")
+    # Monthly PDFs usually share a password, so let every worker try the first file's one first
+    if pdf_files and len(passwords) > 1:
+        pwd = find_password(pdf_files[0][1], passwords)
+        if pwd is not None:
+            passwords = [pwd] + [p for p in passwords if p != pwd]
+    
+    # PDFs are independent and parsing is CPU-bound, so use processes
+    workers = max(1, min(len(pdf_files), os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = [r for r in executor.map(_parse_one, pdf_files, repeat(passwords), repeat(collect_raw)) if r]
     
+    results.sort(key=lambda x: x['sort_key'])
     return results
 
 
 def save_to_database(results: list, db_path: str):
     """Save all results to SQLite database."""
-    if os.path.exists(db_path):
-        os.remove(db_path)
+    for path in (db_path, db_path + '-wal', db_path + '-shm'):
+        if os.path.exists(path):
+            os.remove(path)
     
-    db = LohnjournalDatabase(db_path)
+    db = LohnjournalDatabase(db_path, rebuild=True)
     for result in results:
         print(f"Saving {result['month_name']} {result['year']}...")
-        db.create_table(result['table_name'])
-        db.insert_employees(result['table_name'], result['employees'])
+        table_name = db.create_table(result['table_name'])
+        db.insert_rows(table_name, result['df'].itertuples(index=False, name=None))
     db.close()
     print(f"Database saved: {db_path}")
 
 
 def create_summary(results: list) -> tuple[pd.DataFrame, list]:
     """Create summary DataFrame aggregating all months."""
-    employee_data = {}
-    months = []
+    months = [f"{result['month_name']} {result['year']}" for result in results]
     
-    for result in results:
-        months.append(f"{result['month_name']} {result['year']}")
+    frames = [result['df'] for result in results if len(result['df'])]
+    if not frames:
+        return pd.DataFrame(columns=['pers_nr', 'name', 'months_count'] + SUM_COLUMNS), months
+    
+    grouped = pd.concat(frames, ignore_index=True).groupby('pers_nr', sort=True)
+    df = grouped.agg({
+        'name': lambda s: max(s, key=len),  # longest spelling across months
+        **{col: 'sum' for col in SUM_COLUMNS},
+    })
+    df.insert(1, 'months_count', grouped.size())
+    return df.reset_index(), months
+
+
+@lru_cache(maxsize=None)
+def _column_letter(index: int) -> str:
+    """Convert a 0-based column index to its Excel letter (0 -> 'A', 26 -> 'AA')."""
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _cell_xml(ref: str, value) -> str:
+    """Render one cell; None/NaN become no cell at all."""
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return ''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        number = repr(value)
+        return f'<c r="{ref}"><v>{number[:-2] if number.endswith(".0") else number}</v></c>'
+    text = escape(_XML_ILLEGAL_RE.sub('', str(value)))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def write_xlsx_fast(path: str, sheets: dict[str, Iterable[tuple]]):
+    """Write unstyled sheets to an XLSX file, streaming each sheet's XML into the zip."""
+    names = list(sheets)
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + ''.join(
+                f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                for n in range(1, len(names) + 1)
+            )
+            + '</Types>'
+        ))
+        zf.writestr('_rels/.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Target="xl/workbook.xml" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+            '</Relationships>'
+        ))
+        zf.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + ''.join(
+                f'<sheet name={quoteattr(name)} sheetId="{n}" r:id="rId{n}"/>'
+                for n, name in enumerate(names, start=1)
+            )
+            + '</sheets></workbook>'
+        ))
+        zf.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + ''.join(
+                f'<Relationship Id="rId{n}" Target="worksheets/sheet{n}.xml" '
+                'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+                for n in range(1, len(names) + 1)
+            )
+            + '</Relationships>'
+        ))
         
-        for emp in result['employees']:
-            key = emp.pers_nr
-            if key not in employee_data:
-                employee_data[key] = {'pers_nr': key, 'name': emp.name, 'months_count': 0}
-                for col in SUM_COLUMNS:
-                    employee_data[key][col] = 0.0
-            
-            if emp.name and len(emp.name) > len(employee_data[key].get('name', '')):
-                employee_data[key]['name'] = emp.name
-            
-            employee_data[key]['months_count'] += 1
-            
-            for col in SUM_COLUMNS:
-                val = getattr(emp, col, None)
-                if val is not None:
-                    employee_data[key][col] += val
-    
-    df = pd.DataFrame(list(employee_data.values())).sort_values('pers_nr')
-    return df, months
+        for n, rows in enumerate(sheets.values(), start=1):
+            with zf.open(f'xl/worksheets/sheet{n}.xml', 'w') as f:
+                f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+                for r, row in enumerate(rows, start=1):
+                    cells = ''.join(_cell_xml(f'{_column_letter(c)}{r}', v) for c, v in enumerate(row))
+                    if cells:
+                        f.write(f'<row r="{r}">{cells}</row>'.encode())
+                f.write(b'</sheetData></worksheet>')
+
+
+def _unique_sheet_name(name: str, taken: set) -> str:
+    """Cut name to Excel's 31 chars and add _2, _3, ... if it is taken (case-insensitive)."""
+    sheet_name = name[:31]
+    n = 1
+    while sheet_name.lower() in taken:
+        n += 1
+        suffix = f"_{n}"
+        sheet_name = name[:31 - len(suffix)] + suffix
+    taken.add(sheet_name.lower())
+    return sheet_name
 
 
 def export_to_excel(results: list, excel_path: str):
     """Export all data to Excel with summary and monthly sheets."""
-    with pd.ExcelWriter(excel_path, engine='openpyxl') as writer:
-        # Summary sheet
-        summary_df, months = create_summary(results)
-        
-        header = pd.DataFrame([
-            {'Info': 'ZUSAMMENFASSUNG', 'Value': ''},
-            {'Info': 'Zeitraum:', 'Value': f"{months[0]} - {months[-1]}" if months else 'N/A'},
-            {'Info': 'Anzahl Monate:', 'Value': len(months)},
-            {'Info': '', 'Value': ''},
-        ])
-        header.to_excel(writer, sheet_name='Zusammenfassung', index=False)
-        
-        summary_cols = ['pers_nr', 'name', 'months_count'] + SUM_COLUMNS
-        available_cols = [c for c in summary_cols if c in summary_df.columns]
-        summary_df[available_cols].to_excel(writer, sheet_name='Zusammenfassung', index=False, startrow=6)
-        print(f"  Created summary: {len(summary_df)} employees")
-        
-        # Monthly sheets
-        for result in results:
-            sheet_name = f"{result['month_name']}_{result['year']}"[:31]
-            
-            rows = [{col: getattr(emp, col, None) for col in EXPORT_COLUMNS} for emp in result['employees']]
-            pd.DataFrame(rows).to_excel(writer, sheet_name=sheet_name, index=False)
-            print(f"  Created: {sheet_name} ({len(rows)} employees)")
+    # Summary sheet
+    summary_df, months = create_summary(results)
+    
+    summary_cols = ['pers_nr', 'name', 'months_count'] + SUM_COLUMNS
+    available_cols = [c for c in summary_cols if c in summary_df.columns]
+    sheets = {
+        'Zusammenfassung': chain(
+            [
+                ('Info', 'Value'),
+                ('ZUSAMMENFASSUNG',),
+                ('Zeitraum:', f"{months[0]} - {months[-1]}" if months else 'N/A'),
+                ('Anzahl Monate:', len(months)),
+                (),
+                (),
+                available_cols,
+            ],
+            summary_df[available_cols].itertuples(index=False, name=None),
+        ),
+    }
+    print(f"  Created summary: {len(summary_df)} employees")
+    
+    # Monthly sheets
+    taken = {name.lower() for name in sheets}
+    for result in results:
+        sheet_name = _unique_sheet_name(f"{result['month_name']}_{result['year']}", taken)
+        month_df = result['df'][EXPORT_COLUMNS]
+        sheets[sheet_name] = chain([EXPORT_COLUMNS], month_df.itertuples(index=False, name=None))
+        print(f"  Created: {sheet_name} ({len(month_df)} employees)")
     
+    write_xlsx_fast(excel_path, sheets)
     print(f"Excel exported: {excel_path}")
 
 
@@ -178,20 +305,21 @@ def main():
     parser.add_argument('--db', '-d', help='Database output path')
     parser.add_argument('--excel', '-e', help='Excel output path')
     parser.add_argument('--name', '-n', default='lohnjournal_complete', help='Base name for output files')
-    parser.add_argument('--password', '-P', help='PDF password')
+    parser.add_argument('--password', '-P', action='append', help='PDF password (repeat to try several)')
+    parser.add_argument('--with-raw', action='store_true', help='Store raw row text in the database')
     
     args = parser.parse_args()
     
     base_dir = Path(__file__).parent
     db_path = args.db or base_dir / f'{args.name}.db'
     excel_path = args.excel or base_dir / f'{args.name}_export.xlsx'
-    passwords = [args.password] if args.password else ['']
+    passwords = args.password or ['']
     
     print("=" * 50)
     print("LOHNJOURNAL IMPORT")
     print("=" * 50)
     
-    results = process_pdfs(args.pdf_folder, passwords)
+    results = process_pdfs(args.pdf_folder, passwords, collect_raw=args.with_raw)
     
     if not results:
         print("No PDFs processed!")
@@ -202,7 +330,7 @@ def main():
     save_to_database(results, str(db_path))
     export_to_excel(results, str(excel_path))
     
-    total = sum(len(r['employees']) for r in results)
+    total = sum(len(r['df']) for r in results)
     print(f"\nComplete! {len(results)} months, {total} total records")
     print(f"Database: {db_path}")
     print(f"Excel: {excel_path}")
@@ -2,14 +2,17 @@
 """DATEV Lohnjournal PDF Parser - Coordinate-based extraction."""
 
 import re
+import math
+import ctypes
 import sqlite3
 import argparse
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterable, Iterator
 from collections import defaultdict
 
-import pdfplumber
+import numpy as np
+import pypdfium2 as pdfium
 
 
 @dataclass
@@ -67,6 +70,9 @@ class EmployeeRecord:
     raw_lines: List[str] = field(default_factory=list)
 
 
+_CLEAN_DIGITS_RE = re.compile(r'[^\d]')
+
+
 def parse_german_number(value: str) -> Optional[float]:
     """Parse DATEV number format (e.g., '2.43000' = 2430.00, '18041' = 180.41)."""
     if not value or value.strip() in ('', 'Z', 'E'):
@@ -77,7 +83,9 @@ def parse_german_number(value: str) -> Optional[float]:
     if is_negative:
         value = value[:-1]
     
-    value = re.sub(r'[^\d]', '', value)
+    # Plain digit strings are the common case and need no cleaning
+    if not value.isdecimal():
+        value = _CLEAN_DIGITS_RE.sub('', value)
     if not value:
         return None
     
@@ -144,6 +152,33 @@ COLUMNS = {
     },
 }
 
+def _build_column_lookup(columns: Dict[str, tuple]) -> tuple:
+    """Build a sorted interval lookup for column ranges (excluding 'name').
+    
+    Ranges may overlap, so the sorted range boundaries split the axis into
+    slots (slot 2i+1 is boundary i, slot 2i the gap before it), and each slot
+    is owned by the first column in COLUMNS order that covers it (-1 if none).
+    """
+    ranges = [(f, r) for f, r in columns.items() if f != 'name']
+    field_names = [f for f, _ in ranges]
+    bounds = sorted({x for _, r in ranges for x in r})
+    
+    def first_match(x):
+        return next((i for i, (_, (min_x, max_x)) in enumerate(ranges) if min_x <= x <= max_x), -1)
+    
+    owners = [-1]
+    for i, x in enumerate(bounds):
+        if i:
+            owners.append(first_match((bounds[i - 1] + x) / 2))
+        owners.append(first_match(x))
+    owners.append(-1)
+    
+    return np.array(bounds, dtype=np.float64), np.array(owners), field_names
+
+
+_COLUMN_LOOKUP = {row_type: _build_column_lookup(cols) for row_type, cols in COLUMNS.items()}
+
+
 # Fields that need numeric parsing
 NUMERIC_FIELDS = {
     'kv_brutto', 'rv_brutto', 'av_brutto', 'pv_brutto', 'gesamtbrutto',
@@ -158,130 +193,209 @@ NUMERIC_FIELDS = {
 # Fields that are integers
 INT_FIELDS = {'st_tage', 'sv_tage'}
 
+# Document metadata patterns, matched against the first Lohnjournal page
+METADATA_PATTERNS = {
+    'berater': re.compile(r'Berater:\s*(\d+)'),
+    'mandant': re.compile(r'Mandant:\s*(\d+)'),
+    'datum': re.compile(r'Datum:\s*([\d.]+)'),
+    'monat': re.compile(r'Lohnjournal\s+(\w+\s+\d{4})'),
+}
+
+_NB_SUFFIX_RE = re.compile(r'\s*NB\s*$')
+_TABLE_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9_]')
+
 AG_ROW_CODES = {'01111', '00110'}
 MINIJOB_ROW_CODES = {'26500', '26100'}
 TAX_ROW_CODES = {'1', '2', '3', '4', '5', '6'}
 
+# Sub-row code -> (row_type, skip_x)
+_ROW_KIND = {
+    **{code: ('tax', 130) for code in TAX_ROW_CODES},
+    **{code: ('ag', 65) for code in AG_ROW_CODES},
+    **{code: ('minijob', 65) for code in MINIJOB_ROW_CODES},
+}
+
+
+# Max gap between characters of one word, like pdfplumber's x/y_tolerance
+X_TOLERANCE = 3
+Y_TOLERANCE = 3
+
+
+def extract_words(page: pdfium.PdfPage, textpage: pdfium.PdfTextPage) -> List[dict]:
+    """Group page characters into words with pdfplumber-compatible coordinates.
+    
+    Coordinates are in points from the top-left of the displayed (rotated) page.
+    As in pdfminer, 'top' is the descent line minus the font size, so the
+    COLUMNS ranges and row grouping work unchanged. The font size is scaled by
+    the text matrix, since some producers set '1 Tf' and size text via Tm/cm.
+    """
+    left, bottom, right, top = page.get_mediabox()
+    rotation = page.get_rotation()
+    n_chars = textpage.count_chars()
+    text = textpage.get_text_range(0, n_chars)
+    if len(text) != n_chars:  # chars outside the BMP
+        text = [textpage.get_text_range(i, 1) for i in range(n_chars)]
+    
+    matrix = pdfium.raw.FS_MATRIX()
+    words = []
+    word = None
+    prev_x0 = 0.0
+    for i, char in enumerate(text):
+        if not char or pdfium.raw.FPDFText_IsGenerated(textpage.raw, i) == 1:
+            continue  # PDFium inserts spaces for gaps >~1.2pt; X_TOLERANCE decides instead
+        if char.isspace():
+            word = None
+            continue
+        
+        # Map the char box to the displayed page, mirroring pdfminer's rotation ctm
+        cl, cb, cr, ct = textpage.get_charbox(i, loose=True)
+        if rotation == 90:
+            x0, x1, y_top, y_bottom = cb - bottom, ct - bottom, cl - left, cr - left
+        elif rotation == 180:
+            x0, x1, y_top, y_bottom = right - cr, right - cl, cb - bottom, ct - bottom
+        elif rotation == 270:
+            x0, x1, y_top, y_bottom = top - ct, top - cb, right - cr, right - cl
+        else:
+            x0, x1, y_top, y_bottom = cl - left, cr - left, top - ct, top - cb
+        
+        # Same rule as pdfplumber: no jump left of the previous char, no gap beyond the tolerance
+        if (word and prev_x0 <= x0 <= word['x1'] + X_TOLERANCE
+                and abs(y_bottom - word['bottom']) <= Y_TOLERANCE):
+            word['text'] += char
+            word['x1'] = x1
+        else:
+            font_size = pdfium.raw.FPDFText_GetFontSize(textpage.raw, i)
+            if pdfium.raw.FPDFText_GetMatrix(textpage.raw, i, ctypes.byref(matrix)):
+                font_size *= math.hypot(matrix.c, matrix.d)
+            word = {
+                'text': char, 'x0': x0, 'x1': x1, 'bottom': y_bottom,
+                'top': y_bottom - font_size if font_size else y_top,
+            }
+            words.append(word)
+        prev_x0 = x0
+    
+    return words
+
 
 class CoordinateLohnjournalParser:
     """Parser using coordinate-based column detection."""
     
-    def __init__(self, pdf_path: str, password: str | None = None):
+    def __init__(self, pdf_path: str, password: str | None = None, collect_raw: bool = False,
+                 pdf: pdfium.PdfDocument | None = None):
         self.pdf_path = pdf_path
         self.password = password
+        self.pdf = pdf  # already opened handle, reused instead of opening pdf_path again
+        self.collect_raw = collect_raw  # keep raw row text (only needed for the DB dump)
         self.employees: List[EmployeeRecord] = []
         self.metadata: Dict[str, Any] = {}
         
     def parse(self) -> List[EmployeeRecord]:
         """Parse the PDF and return employee records."""
-        with pdfplumber.open(self.pdf_path, password=self.password) as pdf:
-            pages = [
-                (i, p) for i, p in enumerate(pdf.pages)
-                if 'Lohnjournal' in (p.extract_text() or '') and 'Form.-Nr.LOA313' in (p.extract_text() or '')
-            ]
+        self.employees.extend(self.iter_parse())
+        return self.employees
+    
+    def iter_parse(self) -> Iterator[EmployeeRecord]:
+        """Parse the PDF, yielding each employee record as soon as it is complete."""
+        pdf = self.pdf if self.pdf is not None else pdfium.PdfDocument(self.pdf_path, password=self.password or None)
+        self.pdf = None  # closed below, so a second parse() reopens the file
+        try:  # pypdfium2 4.x documents are not context managers
+            # Extract words once per page; the page text is built from them, so PDFium's
+            # generated spaces cannot split markers like 'Form.-Nr.LOA313'
+            pages = []
+            for i, p in enumerate(pdf):
+                words = extract_words(p, p.get_textpage())
+                text = ' '.join(word['text'] for word in words)
+                if 'Lohnjournal' in text and 'Form.-Nr.LOA313' in text:
+                    pages.append((i, words, text))
             
             print(f"Found {len(pages)} Lohnjournal pages")
             
-            for page_num, page in pages:
-                self._parse_page(page)
-                
+            # Metadata first, so it is available while records are still streaming
             if pages:
-                self._extract_metadata(pages[0][1])
-                
-        return self.employees
+                self._extract_metadata(pages[0][2])
+            
+            for page_num, words, _ in pages:
+                yield from self._parse_page(words)
+        finally:
+            pdf.close()
     
-    def _extract_metadata(self, page):
-        """Extract document metadata from first page."""
-        text = page.extract_text() or ''
-        patterns = {
-            'berater': r'Berater:\s*(\d+)',
-            'mandant': r'Mandant:\s*(\d+)',
-            'datum': r'Datum:\s*([\d.]+)',
-            'monat': r'Lohnjournal\s+(\w+\s+\d{4})',
-        }
-        for key, pattern in patterns.items():
-            if match := re.search(pattern, text):
+    def _extract_metadata(self, text: str):
+        """Extract document metadata from the text of the first page."""
+        for key, pattern in METADATA_PATTERNS.items():
+            if match := pattern.search(text):
                 self.metadata[key] = match.group(1)
         print(f"Metadata: {self.metadata}")
     
-    def _parse_page(self, page):
-        """Parse a single page."""
-        words = page.extract_words(keep_blank_chars=False, x_tolerance=3, y_tolerance=3)
-        
-        # Group words by Y coordinate
-        rows = defaultdict(list)
+    def _parse_page(self, words: List[dict]) -> Iterator[EmployeeRecord]:
+        """Parse a single page from its extract_words() output, yielding its employee records."""
+        # Group words by Y coordinate, as parallel (x0s, texts) columns per row
+        rows = defaultdict(lambda: ([], []))
         for word in words:
-            y_key = round(word['top'] / 2) * 2
-            rows[y_key].append(word)
+            x0_list, text_list = rows[round(word['top'] / 2) * 2]
+            x0_list.append(word['x0'])
+            text_list.append(word['text'])
         
         current_emp = None
         
-        for y_pos, row_words in sorted(rows.items()):
-            row_words.sort(key=lambda w: w['x0'])
-            if not row_words or y_pos < 95:
+        for y_pos, (x0_list, text_list) in sorted(rows.items()):
+            if y_pos < 95:
                 continue
             
-            first = row_words[0]['text']
+            order = np.argsort(x0_list, kind='stable')
+            x0s = np.asarray(x0_list, dtype=np.float64)[order]
+            texts = np.asarray(text_list, dtype=object)[order]
+            first = texts[0]
+            kind = _ROW_KIND.get(first)
             
             # New employee row: 5-digit ID at left edge
-            if (first.isdigit() and len(first) == 5 and 
-                first not in AG_ROW_CODES and first not in MINIJOB_ROW_CODES and
-                row_words[0]['x0'] < 35):
+            if kind is None and first.isdigit() and len(first) == 5 and x0s[0] < 35:
                 
                 if current_emp:
-                    self.employees.append(current_emp)
+                    yield current_emp
                 current_emp = EmployeeRecord(pers_nr=first)
-                self._parse_row(current_emp, row_words, 'main')
+                self._parse_row(current_emp, x0s, texts, 'main')
                 
             elif current_emp:
                 # Sub-row for current employee
-                current_emp.raw_lines.append(' '.join(w['text'] for w in row_words))
+                if self.collect_raw:
+                    current_emp.raw_lines.append(' '.join(texts))
                 
-                if first in TAX_ROW_CODES:
+                if kind:
                     current_emp.sub_row_codes.append(first)
-                    self._parse_row(current_emp, row_words, 'tax', skip_x=130)
-                elif first in AG_ROW_CODES:
-                    current_emp.sub_row_codes.append(first)
-                    self._parse_row(current_emp, row_words, 'ag', skip_x=65)
-                elif first in MINIJOB_ROW_CODES:
-                    current_emp.sub_row_codes.append(first)
-                    self._parse_row(current_emp, row_words, 'minijob', skip_x=65)
+                    self._parse_row(current_emp, x0s, texts, kind[0], skip_x=kind[1])
         
         if current_emp:
-            self.employees.append(current_emp)
+            yield current_emp
     
-    def _parse_row(self, emp: EmployeeRecord, words: List[dict], row_type: str, skip_x: float = 60):
-        """Parse a row using column definitions."""
-        if row_type == 'main':
-            emp.raw_lines.append(' '.join(w['text'] for w in words))
+    def _parse_row(self, emp: EmployeeRecord, x0s: np.ndarray, texts: np.ndarray, row_type: str,
+                   skip_x: float = 60):
+        """Parse a row (x0s and texts sorted by x0) using column definitions."""
+        if row_type == 'main' and self.collect_raw:
+            emp.raw_lines.append(' '.join(texts))
         
-        columns = COLUMNS[row_type]
+        keep = (x0s >= skip_x) & (texts != 'Z') & (texts != 'E')
         
-        for word in words:
-            x0 = word['x0']
-            text = word['text']
-            
-            if x0 < skip_x or text in ('Z', 'E'):
-                continue
-            
-            # Special handling for name field (accumulates text)
-            if row_type == 'main' and 'name' in columns:
-                name_range = columns['name']
-                if name_range[0] <= x0 <= name_range[1] and not text.replace('.', '').replace(',', '').isdigit():
+        # Special handling for name field (accumulates text)
+        if row_type == 'main':
+            name_min, name_max = COLUMNS['main']['name']
+            for i in np.flatnonzero(keep & (x0s >= name_min) & (x0s <= name_max)):
+                text = texts[i]
+                if not text.replace('.', '').replace(',', '').isdigit():
                     emp.name = f"{emp.name} {text}".strip() if emp.name else text
-                    continue
-            
-            # Match word to column
-            for field_name, (min_x, max_x) in columns.items():
-                if field_name == 'name':
-                    continue
-                if min_x <= x0 <= max_x:
-                    self._set_field(emp, field_name, text)
-                    break
+                    keep[i] = False
+        
+        # Match remaining words to columns via interval lookup, first matching column wins
+        x0s, texts = x0s[keep], texts[keep]
+        bounds, owners, field_names = _COLUMN_LOOKUP[row_type]
+        pos = np.searchsorted(bounds, x0s)
+        on_bound = bounds[np.minimum(pos, len(bounds) - 1)] == x0s
+        col_idx = owners[2 * pos + on_bound]
+        for i in np.flatnonzero(col_idx >= 0):
+            self._set_field(emp, field_names[col_idx[i]], texts[i])
         
         # Clean name
         if row_type == 'main' and emp.name:
-            emp.name = re.sub(r'\s*NB\s*$', '', emp.name).strip()
+            emp.name = _NB_SUFFIX_RE.sub('', emp.name).strip()
     
     def _set_field(self, emp: EmployeeRecord, field: str, text: str):
         """Set a field value with appropriate type conversion."""
@@ -312,12 +426,18 @@ class LohnjournalDatabase:
         'st_tage', 'sv_tage', 'sub_row_codes', 'raw_lines',
     ]
     
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, rebuild: bool = False):
         self.conn = sqlite3.connect(db_path)
+        if rebuild:
+            # Throwaway DB rebuilt from the PDFs, so durability can be traded for speed
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=OFF")
+            self.conn.execute("PRAGMA temp_store=MEMORY")
+        self._insert_sql: Dict[str, str] = {}  # sanitized table name -> INSERT statement
         
     def create_table(self, table_name: str) -> str:
         """Create table for Lohnjournal data."""
-        table_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
+        table_name = _TABLE_SANITIZE_RE.sub('_', table_name)
         
         self.conn.execute(f"""
             CREATE TABLE IF NOT EXISTS {table_name} (
@@ -336,26 +456,30 @@ class LohnjournalDatabase:
             )
         """)
         self.conn.commit()
+        
+        placeholders = ', '.join(['?'] * len(self.FIELDS))
+        self._insert_sql[table_name] = f"INSERT INTO {table_name} ({', '.join(self.FIELDS)}) VALUES ({placeholders})"
         return table_name
     
-    def insert_employees(self, table_name: str, employees: List[EmployeeRecord]):
-        """Insert employee records."""
-        table_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
-        placeholders = ', '.join(['?'] * len(self.FIELDS))
-        columns = ', '.join(self.FIELDS)
-        
-        for emp in employees:
-            values = []
-            for f in self.FIELDS:
-                val = getattr(emp, f, None)
-                if f == 'sub_row_codes':
-                    val = ','.join(val) if val else ''
-                elif f == 'raw_lines':
-                    val = '\n'.join(val) if val else ''
-                values.append(val)
-            self.conn.execute(f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})", values)
-        
-        self.conn.commit()
+    def insert_employees(self, table_name: str, employees: Iterable[EmployeeRecord]):
+        """Insert employee records, consuming the iterable lazily (e.g. from iter_parse)."""
+        self.insert_rows(table_name, (tuple(self.field_value(emp, f) for f in self.FIELDS) for emp in employees))
+    
+    def insert_rows(self, table_name: str, rows: Iterable[tuple]):
+        """Insert rows of values in FIELDS order into a table returned by create_table."""
+        sql = self._insert_sql[table_name]
+        with self.conn:  # single transaction, committed on success
+            self.conn.executemany(sql, rows)
+    
+    @staticmethod
+    def field_value(emp: EmployeeRecord, f: str):
+        """Get a field value in its database representation."""
+        val = getattr(emp, f, None)
+        if f == 'sub_row_codes':
+            return ','.join(val) if val else ''
+        if f == 'raw_lines':
+            return '\n'.join(val) if val else ''
+        return val
         
     def close(self):
         self.conn.close()
@@ -369,11 +493,12 @@ def main():
     parser.add_argument('--output', '-o', default='lohnjournal.db', help='Output SQLite database')
     parser.add_argument('--table', '-t', help='Table name')
     parser.add_argument('--debug', '-d', action='store_true', help='Print debug info')
+    parser.add_argument('--with-raw', action='store_true', help='Store raw row text in the database')
     
     args = parser.parse_args()
     
     print(f"Parsing {args.pdf_path}...")
-    lj_parser = CoordinateLohnjournalParser(args.pdf_path, args.password)
+    lj_parser = CoordinateLohnjournalParser(args.pdf_path, args.password, collect_raw=args.with_raw)
     employees = lj_parser.parse()
     
     print(f"\nFound {len(employees)} employees")
@@ -389,7 +514,7 @@ def main():
     
     print(f"\nSaving to {args.output}, table: {table_name}")
     db = LohnjournalDatabase(args.output)
-    db.create_table(table_name)
+    table_name = db.create_table(table_name)
     db.insert_employees(table_name, employees)
     db.close()
     
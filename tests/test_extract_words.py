@@ -0,0 +1,63 @@
+"""extract_words must group characters like pdfplumber's extract_words(x_tolerance=3, y_tolerance=3)."""
+
+import pytest
+import pypdfium2 as pdfium
+
+from lohnjournal_parser import CoordinateLohnjournalParser, extract_words
+
+pdfplumber = pytest.importorskip('pdfplumber')
+canvas = pytest.importorskip('reportlab.pdfgen.canvas')
+pdfmetrics = pytest.importorskip('reportlab.pdfbase.pdfmetrics')
+
+FONT, SIZE = 'Helvetica', 7
+# Gaps between separate text runs; PDFium generates a space from ~1.2pt on
+GAPS = [0.5, 1.2, 1.5, 2.0, 2.5, 2.95, 3.5, 5.0]
+
+
+def _draw_runs(c, x, y, *parts, gap):
+    for part in parts:
+        c.drawString(x, y, part)
+        x += pdfmetrics.stringWidth(part, FONT, SIZE) + gap
+
+
+@pytest.fixture(scope='module')
+def gap_pdf(tmp_path_factory) -> str:
+    """Lohnjournal-like page where words and amounts are drawn as runs with small gaps."""
+    path = str(tmp_path_factory.mktemp('pdf') / 'gaps.pdf')
+    c = canvas.Canvas(path, pagesize=(842, 595))
+    c.setFont(FONT, SIZE)
+    _draw_runs(c, 20, 560, 'Lohnjournal', 'Januar', '2025', gap=3.5)
+    _draw_runs(c, 300, 560, 'Form.-Nr.', 'LOA313', gap=2.0)
+    for k, gap in enumerate(GAPS):
+        y = 450 - 12 * k
+        c.drawString(20, y, f'1000{k}')
+        _draw_runs(c, 150, y, 'Mül', 'ler', gap=gap)
+        _draw_runs(c, 460, y, '2.430', '00', gap=gap)
+    c.save()
+    return path
+
+
+def _plumber_words(path: str) -> list:
+    with pdfplumber.open(path) as pdf:
+        words = pdf.pages[0].extract_words(x_tolerance=3, y_tolerance=3)
+    return [(w['text'], round(w['x0'], 1), round(w['x1'], 1)) for w in words]
+
+
+def test_words_match_pdfplumber(gap_pdf):
+    pdf = pdfium.PdfDocument(gap_pdf)
+    try:
+        page = pdf[0]
+        words = extract_words(page, page.get_textpage())
+    finally:
+        pdf.close()
+    assert [(w['text'], round(w['x0'], 1), round(w['x1'], 1)) for w in words] == _plumber_words(gap_pdf)
+
+
+def test_gapped_amounts_are_parsed_whole(gap_pdf):
+    employees = CoordinateLohnjournalParser(gap_pdf).parse()
+    assert len(employees) == len(GAPS)
+    for emp, gap in zip(employees, GAPS):
+        if gap <= 3:
+            assert (emp.name, emp.kv_brutto) == ('Müller', 2430.0)
+        else:
+            assert emp.name == 'Mül ler' and emp.kv_brutto == 0.0